@@ -0,0 +1,239 @@
+# Copyright Mikael K. Aboagye & WD Studios Corp.
+#
+# Shared subprocess helpers used by the ApertureUI build scripts.
+
+import asyncio
+import functools
+import os
+import platform
+import selectors
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+# Evaluated once at import instead of calling platform.system() for every command.
+_IS_WINDOWS = platform.system() == "Windows"
+
+# Number of bytes read from a subprocess pipe per os.read() call.
+READ_CHUNK_SIZE = 65536
+# Streamed output is written to the console once this many bytes are pending,
+# or once FLUSH_INTERVAL seconds have passed since the last write.
+FLUSH_THRESHOLD = 65536
+FLUSH_INTERVAL = 0.1
+
+@functools.lru_cache(maxsize=256)
+def _exists(path):
+    """
+    Cached os.path.exists() so each workspace path is only stat'd once per run.
+    Each script clears the cache at the start of its main().
+    """
+    return os.path.exists(path)
+
+def _read_chunks(fd):
+    """
+    Yields chunks read from a pipe until EOF. On POSIX the loop sleeps in a single
+    readiness wait (epoll/kqueue via selectors) and reads once per notification; an
+    empty chunk is yielded whenever the pipe has been idle for FLUSH_INTERVAL seconds.
+    """
+    if _IS_WINDOWS:
+        # select() on Windows only supports sockets; a blocking read already waits for data.
+        while True:
+            chunk = os.read(fd, READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            if not selector.select(FLUSH_INTERVAL):
+                yield b''
+                continue
+            chunk = os.read(fd, READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def _stream_output(fd):
+    """
+    Copies a pipe to the console, batching writes: pending output is written and flushed
+    once FLUSH_THRESHOLD bytes are buffered, FLUSH_INTERVAL seconds have passed, or the
+    pipe goes idle. On Windows, where idleness cannot be detected, every chunk is flushed.
+    """
+    out = sys.stdout.buffer
+    pending = bytearray()
+    last_flush = time.monotonic()
+    for chunk in _read_chunks(fd):
+        pending += chunk
+        now = time.monotonic()
+        if _IS_WINDOWS or not chunk or len(pending) >= FLUSH_THRESHOLD or now - last_flush >= FLUSH_INTERVAL:
+            if pending:
+                out.write(pending)
+                out.flush()
+                pending.clear()
+            last_flush = now
+    if pending:
+        out.write(pending)
+        out.flush()
+
+def _needs_windows_shell(command):
+    """
+    True on Windows when the program is not given as a full path: a bare name such as
+    `gclient` may resolve to a .bat file that only cmd.exe's PATH/PATHEXT lookup finds.
+    """
+    return _IS_WINDOWS and not os.path.isabs(command[0])
+
+def run_command(command, cwd=None, env=None, shell=None):
+    """
+    Runs a command and streams its combined stdout/stderr to the console in real-time.
+    Raises subprocess.CalledProcessError if the command exits with a non-zero code.
+
+    When `shell` is None it is chosen automatically: list commands run without a shell
+    on POSIX (exec'd directly). On Windows the shell is only used when the program is
+    given by bare name, since it may resolve to a depot_tools batch file.
+    String commands always go through the shell.
+    """
+    if shell is None:
+        shell = isinstance(command, str) or _needs_windows_shell(command)
+    if shell and not isinstance(command, str):
+        command = subprocess.list2cmdline(command) if _IS_WINDOWS else shlex.join(command)
+
+    process = subprocess.Popen(
+        command,
+        cwd=cwd,
+        shell=shell,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=-1,
+        env=env
+    )
+
+    # Stream the raw output in real-time, a large chunk at a time.
+    sys.stdout.flush()
+    _stream_output(process.stdout.fileno())
+
+    process.stdout.close()
+    return_code = process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, command)
+
+def chain_commands(commands):
+    """
+    Joins several argument lists into a single shell command line linked with `&&`,
+    so the shell runs each stage in turn and stops at the first one that fails.
+    """
+    quote = subprocess.list2cmdline if _IS_WINDOWS else shlex.join
+    return ' && '.join(quote(command) for command in commands)
+
+async def _stream_command(command, cwd, env, queue, processes):
+    """
+    Runs one command under asyncio and forwards its output to `queue` in whole lines,
+    so that output from concurrently running commands does not interleave mid-line.
+    """
+    # Each command gets its own process group so that it can be killed with all of its children.
+    if _IS_WINDOWS:
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group = {"start_new_session": True}
+    if _needs_windows_shell(command):
+        process = await asyncio.create_subprocess_shell(
+            subprocess.list2cmdline(command), cwd=cwd, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, **group)
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *command, cwd=cwd, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, **group)
+    processes.append(process)
+
+    pending = b''
+    while True:
+        chunk = await process.stdout.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += chunk
+        end = pending.rfind(b'\n') + 1
+        if end:
+            await queue.put(pending[:end])
+            pending = pending[end:]
+    if pending:
+        await queue.put(pending + b'\n')
+
+    return_code = await process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, command)
+
+def _kill_process_tree(process):
+    """
+    Kills a process started by _stream_command together with everything it spawned
+    (e.g. node and npm's lifecycle scripts, or the programs run by cmd.exe), so that
+    nothing is left holding its output pipe open.
+    """
+    if _IS_WINDOWS:
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+async def _run_concurrently(jobs, env):
+    queue = asyncio.Queue()
+    processes = []
+
+    async def write_output():
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+
+    def terminate(signum):
+        # The jobs run in their own sessions, so a SIGTERM/SIGHUP aimed at this script
+        # (or its terminal going away) would not reach them; kill them before exiting.
+        for process in processes:
+            if process.returncode is None:
+                _kill_process_tree(process)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    loop = asyncio.get_running_loop()
+    forwarded_signals = [] if _IS_WINDOWS else [signal.SIGTERM, signal.SIGHUP]
+    for signum in forwarded_signals:
+        loop.add_signal_handler(signum, terminate, signum)
+
+    writer = asyncio.create_task(write_output())
+    tasks = [asyncio.create_task(_stream_command(command, cwd, env, queue, processes)) for command, cwd in jobs]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        # On the first failure stop everything else that is still running, without
+        # waiting for the killed commands' output to drain.
+        for process in processes:
+            if process.returncode is None:
+                _kill_process_tree(process)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for process in processes:
+            await process.wait()
+        await queue.put(None)
+        await writer
+        for signum in forwarded_signals:
+            loop.remove_signal_handler(signum)
+
+def run_commands_concurrently(jobs, env=None):
+    """
+    Runs several independent commands at the same time.
+    `jobs` is a sequence of (command, cwd) pairs; each command is a list of arguments.
+    Their combined output is streamed to the console line by line as it arrives.
+    Raises subprocess.CalledProcessError for the first command that fails, after
+    killing the ones still running.
+    """
+    sys.stdout.flush()
+    asyncio.run(_run_concurrently(jobs, env))
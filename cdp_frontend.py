@@ -4,6 +4,16 @@ import sys
 import platform
 import shutil
 import argparse
+import stat
+import threading
+
+import _run
+
+# Optional: batched unlinks through io_uring on Linux (pip install liburing).
+try:
+    import liburing
+except ImportError:
+    liburing = None
 
 # --- Configuration (Relative Names) ---
 # These are now relative names; the full paths will be built inside the workspace.
@@ -11,6 +21,18 @@ DEPOT_TOOLS_SUBDIR = "depot_tools"
 DEVTOOLS_PARENT_SUBDIR = "devtools"
 DEVTOOLS_FRONTEND_REPO_SUBDIR = "devtools-frontend"
 
+# Commands the build needs on PATH. On Windows, they are .bat files (npm is a .cmd).
+_WIN_COMMANDS = ("gclient.bat", "fetch.bat", "npm.cmd", "gn.bat", "autoninja.bat")
+_POSIX_COMMANDS = ("gclient", "fetch", "npm", "gn", "autoninja")
+_REQUIRED_COMMANDS = _WIN_COMMANDS if _run._IS_WINDOWS else _POSIX_COMMANDS
+
+# Resolved full paths of required commands, cached for the lifetime of the process.
+_cmd_locations = {}
+_cmd_locations_lock = threading.Lock()
+
+# Number of unlink requests submitted to io_uring with a single syscall.
+URING_BATCH_SIZE = 1024
+
 def run_command(command, working_dir):
     """
     Runs a command in a specified directory with detailed logging and error handling.
@@ -19,31 +41,8 @@ def run_command(command, working_dir):
     print(f"\n--- Running Command: {' '.join(command)}")
     print(f"--- In Directory: {os.path.abspath(working_dir)}")
     try:
-        # Use shell=True on Windows because many depot_tools commands are batch files.
-        use_shell = platform.system() == "Windows"
-        process = subprocess.Popen(
-            command,
-            cwd=working_dir,
-            shell=use_shell,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            env=os.environ # Explicitly pass the current environment
-        )
-
-        # Stream the output in real-time.
-        for line in iter(process.stdout.readline, ''):
-            print(line, end='')
-        
-        process.stdout.close()
-        return_code = process.wait()
-
-        if return_code:
-            # Raise an exception that the main function can catch to trigger cleanup.
-            raise subprocess.CalledProcessError(return_code, command)
-            
+        # No env is passed: the child inherits os.environ (including the depot_tools PATH set in main).
+        _run.run_command(command, cwd=working_dir)
         print(f"--- Command finished successfully.")
 
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
@@ -52,51 +51,104 @@ def run_command(command, working_dir):
         # Re-raise the exception to be handled by the main try...except block.
         raise e
 
+def run_commands_concurrently(commands, working_dir):
+    """
+    Runs several independent commands in the same directory at the same time.
+    Raises an exception as soon as any of them fails.
+    """
+    for command in commands:
+        print(f"\n--- Running Command: {' '.join(command)}")
+    print(f"--- In Directory: {os.path.abspath(working_dir)}")
+    try:
+        _run.run_commands_concurrently([(command, working_dir) for command in commands])
+        print(f"--- Commands finished successfully.")
+
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        print(f"\n[ERROR] Command failed: {e}", file=sys.stderr)
+        print(f"[ERROR] In directory: {os.path.abspath(working_dir)}", file=sys.stderr)
+        raise e
+
 def check_prerequisites(workspace_dir):
     """
     Checks if Git and npm are installed on the system.
     """
     print("--- Checking for prerequisites (Git, npm)...")
     try:
-        run_command(["git", "--version"], workspace_dir)
-        run_command(["npm", "--version"], workspace_dir)
+        # The two probes are independent, so run them side by side.
+        run_commands_concurrently([["git", "--version"], ["npm", "--version"]], workspace_dir)
     except Exception as e:
         print("[ERROR] Git and/or npm are not installed or not in your PATH.", file=sys.stderr)
         print("Please install them before running this script.", file=sys.stderr)
         raise e
     print("--- Prerequisites found.")
 
+def find_executables(names):
+    """
+    Locates several commands with a single walk of PATH, listing each directory once.
+    Returns a dict mapping every name that was found to its full path.
+    """
+    # Windows file names are case-insensitive.
+    wanted = {name.lower() if _run._IS_WINDOWS else name: name for name in names}
+    found = {}
+    seen_dirs = set()
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        if not directory or directory in seen_dirs:
+            continue
+        seen_dirs.add(directory)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    key = entry.name.lower() if _run._IS_WINDOWS else entry.name
+                    name = wanted.get(key)
+                    if name is None or name in found:
+                        continue
+                    if entry.is_file() and os.access(entry.path, os.X_OK):
+                        found[name] = entry.path
+        except OSError:
+            continue
+        if len(found) == len(wanted):
+            break
+    return found
+
+def locate_commands(commands, depot_tools_dir):
+    """
+    Resolves commands to full paths. Each one is first looked up in depot_tools with a single
+    os.stat; only those not found there fall back to a PATH walk. Results are cached.
+    """
+    with _cmd_locations_lock:
+        unresolved = [cmd for cmd in commands if cmd not in _cmd_locations]
+        for cmd in unresolved:
+            candidate = os.path.join(depot_tools_dir, cmd)
+            try:
+                st = os.stat(candidate)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and (_run._IS_WINDOWS or st.st_mode & 0o111):
+                _cmd_locations[cmd] = candidate
+        unresolved = [cmd for cmd in unresolved if cmd not in _cmd_locations]
+        if unresolved:
+            _cmd_locations.update(find_executables(unresolved))
+        return {cmd: _cmd_locations[cmd] for cmd in commands if cmd in _cmd_locations}
+
 def check_environment(workspace_dir):
     """
     Verifies that the depot_tools environment is correctly set up.
     """
     print("\n--- Verifying depot_tools environment...")
-    # Commands to check for. On Windows, they are .bat files.
-    commands_to_check = ["gclient", "fetch", "npm", "gn", "autoninja"]
-    if platform.system() == "Windows":
-        # Adjust for windows command extensions
-        win_cmds = []
-        for cmd in commands_to_check:
-            if cmd == 'npm':
-                win_cmds.append('npm.cmd')
-            else:
-                win_cmds.append(f'{cmd}.bat')
-        commands_to_check = win_cmds
-    
-    for cmd in commands_to_check:
-        try:
-            run_command(["where" if platform.system() == "Windows" else "which", cmd], workspace_dir)
-        except Exception as e:
+    found = locate_commands(_REQUIRED_COMMANDS, os.path.join(workspace_dir, DEPOT_TOOLS_SUBDIR))
+    for cmd in _REQUIRED_COMMANDS:
+        if cmd not in found:
             print(f"[ERROR] Environment check failed. Could not find '{cmd}'.", file=sys.stderr)
             print("[ERROR] Ensure depot_tools was cloned correctly and the PATH is set.", file=sys.stderr)
-            raise e
+            raise FileNotFoundError(cmd)
+        print(f"--- Found {cmd}: {found[cmd]}")
     print("--- Environment sanity check passed.")
 
 def check_path_length(workspace_dir):
     """
     On Windows, warns the user if the workspace path is excessively long.
     """
-    if platform.system() == "Windows":
+    if _run._IS_WINDOWS:
         path = os.path.abspath(workspace_dir)
         # MAX_PATH is 260, but we'll warn sooner.
         if len(path) > 150:
@@ -108,6 +160,114 @@ def check_path_length(workspace_dir):
             print("a shorter workspace path (e.g., C:\\build).")
             print("---------------------------------------------------------")
 
+def _uring_supported():
+    """
+    io_uring unlinkat (IORING_OP_UNLINKAT) needs Linux 5.11 or later and the liburing package.
+    """
+    if liburing is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        version = tuple(int(part) for part in platform.release().split("-")[0].split(".")[:2])
+    except ValueError:
+        return False
+    return version >= (5, 11)
+
+def _uring_unlink_batch(ring, cqe, paths, flags):
+    """
+    Queues one unlinkat per path, submits them with a single syscall and drains the completions.
+    Failures are ignored; anything left behind is removed by the shutil.rmtree fallback.
+    """
+    for path in paths:
+        sqe = liburing.io_uring_get_sqe(ring)
+        liburing.io_uring_prep_unlink(sqe, path, flags)
+    liburing.io_uring_submit(ring)
+    liburing.io_uring_wait_cqe_nr(ring, cqe, len(paths))
+    liburing.io_uring_cq_advance(ring, liburing.io_uring_cq_ready(ring))
+
+def _remove_tree_uring(path):
+    """
+    Deletes a directory tree by walking it with os.scandir and unlinking its entries
+    through io_uring in batches of URING_BATCH_SIZE.
+    """
+    files = []
+    dirs_by_depth = []
+    stack = [(path, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        if len(dirs_by_depth) <= depth:
+            dirs_by_depth.append([])
+        dirs_by_depth[depth].append(directory)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, depth + 1))
+                else:
+                    files.append(entry.path)
+
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(URING_BATCH_SIZE, ring)
+    try:
+        for start in range(0, len(files), URING_BATCH_SIZE):
+            _uring_unlink_batch(ring, cqe, files[start:start + URING_BATCH_SIZE], 0)
+        # Directories are removed deepest level first so every batch only holds empty ones.
+        for dirs in reversed(dirs_by_depth):
+            for start in range(0, len(dirs), URING_BATCH_SIZE):
+                _uring_unlink_batch(ring, cqe, dirs[start:start + URING_BATCH_SIZE], liburing.AT_REMOVEDIR)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+def remove_tree(path):
+    """
+    Deletes a directory tree, ignoring errors.
+    On Linux with liburing installed the unlinks are batched through io_uring;
+    everywhere else (and for anything io_uring left behind) shutil.rmtree does the work.
+    """
+    if _uring_supported():
+        try:
+            _remove_tree_uring(path)
+        except OSError:
+            pass
+    shutil.rmtree(path, ignore_errors=True)
+
+def discard_workspace(workspace_dir):
+    """
+    Moves the workspace aside with a single rename and deletes it from a detached
+    background process, so a failed build can exit immediately.
+    Falls back to deleting in place with remove_tree() if either step is not possible.
+    Returns True if the deletion continues in the background, False if it is already done.
+    """
+    trash_dir = f"{workspace_dir}.trash.{os.getpid()}"
+    try:
+        os.replace(workspace_dir, trash_dir)
+    except OSError:
+        remove_tree(workspace_dir)
+        return False
+
+    if _run._IS_WINDOWS:
+        command = ["cmd", "/c", "rmdir", "/s", "/q", trash_dir]
+        options = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        # Persist the rename so a crash cannot bring the old workspace back. This is best
+        # effort: some filesystems do not support fsync on a directory.
+        try:
+            parent_fd = os.open(os.path.dirname(trash_dir), os.O_RDONLY)
+            try:
+                os.fsync(parent_fd)
+            finally:
+                os.close(parent_fd)
+        except OSError:
+            pass
+        command = ["rm", "-rf", trash_dir]
+        options = {"start_new_session": True}
+    try:
+        subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, **options)
+    except OSError:
+        remove_tree(trash_dir)
+        return False
+    return True
+
 def main():
     """
     Main function to orchestrate the entire checkout and build process.
@@ -128,6 +288,7 @@ def main():
     print(f"--- Starting Chrome DevTools Frontend Build in Workspace: {workspace_dir} ---")
     
     build_succeeded = False
+    _run._exists.cache_clear()
 
     try:
         os.makedirs(workspace_dir, exist_ok=True)
@@ -135,26 +296,26 @@ def main():
         check_prerequisites(workspace_dir)
 
         # Clone depot_tools if it doesn't exist. This step is a prerequisite.
-        if not os.path.exists(depot_tools_dir):
-            run_command(["git", "clone", "https://chromium.googlesource.com/chromium/tools/depot_tools.git", depot_tools_dir], workspace_dir)
+        if not _run._exists(depot_tools_dir):
+            # Only the latest depot_tools is needed, so skip its history.
+            run_command(["git", "clone", "--depth=1", "--single-branch", "https://chromium.googlesource.com/chromium/tools/depot_tools.git", depot_tools_dir], workspace_dir)
         else:
             print(f"\n--- Skipping clone, '{depot_tools_dir}' already exists.")
 
         print("\n--- Setting up environment variables...")
         os.environ["PATH"] = depot_tools_dir + os.pathsep + os.environ["PATH"]
-        if platform.system() == "Windows":
+        if _run._IS_WINDOWS:
             os.environ["DEPOT_TOOLS_WIN_TOOLCHAIN"] = "0"
         
         check_environment(workspace_dir)
 
         # Step 1 from docs: `mkdir devtools`
-        if not os.path.exists(devtools_parent_dir):
-            os.makedirs(devtools_parent_dir)
+        os.makedirs(devtools_parent_dir, exist_ok=True)
 
         # Step 2 & 3 from docs: `cd devtools`, `fetch devtools-frontend`
         # The 'fetch' command handles the clone and the initial `gclient sync`.
         frontend_repo_path = os.path.join(devtools_parent_dir, DEVTOOLS_FRONTEND_REPO_SUBDIR)
-        if not os.path.exists(frontend_repo_path):
+        if not _run._exists(frontend_repo_path):
             run_command(["fetch", "devtools-frontend"], devtools_parent_dir)
         else:
             print(f"\n--- Skipping fetch, '{frontend_repo_path}' already exists.")
@@ -163,13 +324,11 @@ def main():
         # The working directory for build commands is the repository itself.
         work_dir = frontend_repo_path
         
-        # Run npm install as per best practices.
-        run_command(["npm", "install"], work_dir)
-
         # **FIX:** Bypass the failing `npm run build` script and use the core build tools directly.
         # This is a more robust way to build and avoids issues with the npm wrapper.
-        # 1. Explicitly generate the build files with `gn`.
-        run_command(["gn", "gen", "out/Default"], work_dir)
+        # 1. Run npm install as per best practices, and explicitly generate the build files
+        #    with `gn` at the same time; `gn gen` only needs the checkout, not node_modules.
+        run_commands_concurrently([["npm", "install"], ["gn", "gen", "out/Default"]], work_dir)
 
         # 2. Compile the code using `autoninja`.
         run_command(["autoninja", "-C", "out/Default"], work_dir)
@@ -187,8 +346,10 @@ def main():
     finally:
         if not build_succeeded:
             print(f"\n--- Build failed. Cleaning up workspace: {workspace_dir}")
-            shutil.rmtree(workspace_dir, ignore_errors=True)
-            print("--- Cleanup complete. Exiting script.")
+            if discard_workspace(workspace_dir):
+                print("--- Cleanup started in the background. Exiting script.")
+            else:
+                print("--- Cleanup complete. Exiting script.")
             sys.exit(1)
 
 if __name__ == "__main__":
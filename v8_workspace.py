@@ -7,7 +7,7 @@
 # Prerequisites:
 # 1.  General:
 #     - Git
-#     - Python 3
+#     - Python 3.8 or later
 #
 # 2.  Windows:
 #     - Windows 10 or later (64-bit).
@@ -21,15 +21,16 @@
 #     - pkg install devel/git python3 devel/clang
 #
 # How to run:
-# 1.  Save this script as a Python file (e.g., `build_v8_advanced.py`).
+# 1.  Keep this script next to `_run.py` (the shared subprocess helpers it imports);
+#     the two files must be copied or shipped together.
 # 2.  Open a terminal or command prompt. For Windows, this MUST be run with
 #     **Administrator privileges**. A Developer Command Prompt is also recommended.
 # 3.  Examples:
 #     - Default build (official V8, static, release):
-#       `python3 build_v8_advanced.py`
+#       `python3 v8_workspace.py`
 #
 #     - Build without the Rust toolchain dependency:
-#       `python3 build_v8_advanced.py --no-rust`
+#       `python3 v8_workspace.py --no-rust`
 #
 
 import os
@@ -37,43 +38,141 @@ import subprocess
 import sys
 import argparse
 import ctypes
+import hashlib
+import json
+import re
+
+import _run
 
 # --- Configuration ---
 # The URL for the depot_tools repository.
 DEPOT_TOOLS_URL = "https://chromium.googlesource.com/chromium/tools/depot_tools.git"
+# The V8 tag checked out when no custom fork is given.
+V8_DEFAULT_TAG = "12.1.285.27"
 
-def run_command(command, working_dir=None, env=None):
+# Written next to the build output: digest of the last `gn gen` command that succeeded.
+GN_ARGS_HASH_FILE = ".args_hash"
+# Written next to the build output: (mtime_ns, size) of every file that `gn gen` read.
+GN_MANIFEST_FILE = ".gn_manifest"
+
+# Abort git transfers that stay below GIT_LOW_SPEED_LIMIT bytes/s for GIT_LOW_SPEED_TIME
+# seconds, so a stalled dependency fetch fails (and gets retried by gclient) quickly.
+GIT_LOW_SPEED_LIMIT = "1000"
+GIT_LOW_SPEED_TIME = "60"
+
+# Remote names parsed from each repository's .git/config, keyed by repository path.
+# Entries are (mtime_ns, size, remotes) so an edited config is re-read.
+_git_remotes_cache = {}
+
+def git_remotes(repo_dir):
+    """
+    Returns the set of remote names configured in a repository by reading its .git/config
+    directly instead of launching git. Returns None if the config file cannot be read.
+    """
+    config_path = os.path.join(repo_dir, ".git", "config")
+    try:
+        st = os.stat(config_path)
+    except OSError:
+        return None
+    cached = _git_remotes_cache.get(repo_dir)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    remotes = set()
+    with open(config_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('[remote "') and line.endswith('"]'):
+                remotes.add(line[len('[remote "'):-2])
+    _git_remotes_cache[repo_dir] = (st.st_mtime_ns, st.st_size, remotes)
+    return remotes
+
+def git_has_tag(repo_dir, tag):
+    """
+    True if `tag` already exists locally, checked by reading .git/refs/tags and
+    .git/packed-refs directly instead of launching git.
+    """
+    git_dir = os.path.join(repo_dir, ".git")
+    if os.path.exists(os.path.join(git_dir, "refs", "tags", tag)):
+        return True
+    ref = f" refs/tags/{tag}"
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), 'r', encoding='utf-8', errors='replace') as f:
+            return any(line.rstrip('\n').endswith(ref) for line in f)
+    except OSError:
+        return False
+
+def gn_command_digest(gn_command):
+    """Returns a short hex digest identifying a `gn gen` invocation."""
+    return hashlib.blake2b('\0'.join(gn_command).encode('utf-8'), digest_size=16).hexdigest()
+
+def gn_input_manifest(build_dir):
     """
-    Executes a shell command and prints its output in real-time.
-    Exits the script if the command fails.
+    Stats every input of the last `gn gen` (BUILD.gn, .gni and .gn files as listed by gn
+    in build.ninja.d) and returns {path: (mtime_ns, size)}, or None if a file is missing.
     """
-    print(f"--- Running command: {' '.join(command)} in '{working_dir}'")
     try:
-        command_str = ' '.join(command)
-        process = subprocess.Popen(
-            command_str,
-            cwd=working_dir,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            shell=True,
-            env=env
-        )
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print(output.strip(), flush=True)
-
-        if process.returncode != 0:
-            print(f"--- Command failed with exit code {process.returncode}")
-            sys.exit(process.returncode)
+        with open(os.path.join(build_dir, "build.ninja.d"), 'r', encoding='utf-8') as f:
+            depfile = f.read()
+    except OSError:
+        return None
+    # Format: "build.ninja: input1 input2 ..." with spaces inside paths escaped as "\ ".
+    inputs = re.split(r'(?<!\\)\s+', depfile.partition(':')[2].strip())
+    manifest = {}
+    for path in inputs:
+        if not path:
+            continue
+        path = path.replace('\\ ', ' ')
+        try:
+            st = os.stat(os.path.join(build_dir, path))
+        except OSError:
+            return None
+        manifest[path] = (st.st_mtime_ns, st.st_size)
+    return manifest
+
+def gn_gen_is_current(build_dir, digest):
+    """
+    True if `build_dir` was already generated by a `gn gen` with the same digest and none
+    of the files gn read have changed since, in which case running gn gen again is a no-op.
+    This looks at the tree as it is before the build chain's checkout and gclient sync;
+    if those change any input afterwards, ninja regenerates build.ninja on its own.
+    """
+    if not os.path.exists(os.path.join(build_dir, "build.ninja")):
+        return False
+    try:
+        with open(os.path.join(build_dir, GN_ARGS_HASH_FILE), 'r') as f:
+            if f.read().strip() != digest:
+                return False
+        with open(os.path.join(build_dir, GN_MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            previous_manifest = {path: tuple(entry) for path, entry in json.load(f).items()}
+    except (OSError, ValueError, TypeError, AttributeError):
+        # Missing, corrupt or unexpected manifest: just run gn gen again.
+        return False
+    return previous_manifest == gn_input_manifest(build_dir)
+
+def record_gn_state(build_dir, digest):
+    """Saves the digest and input manifest that gn_gen_is_current() compares against."""
+    with open(os.path.join(build_dir, GN_ARGS_HASH_FILE), 'w') as f:
+        f.write(digest)
+    manifest = gn_input_manifest(build_dir)
+    if manifest is not None:
+        with open(os.path.join(build_dir, GN_MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
 
+def run_command(command, working_dir=None, env=None):
+    """
+    Executes a command (an argument list, or a shell command line string) and prints its
+    output in real-time. Exits the script if the command fails.
+    """
+    print(f"--- Running command: {command if isinstance(command, str) else ' '.join(command)} in '{working_dir}'")
+    try:
+        _run.run_command(command, cwd=working_dir, env=env)
+    except subprocess.CalledProcessError as e:
+        print(f"--- Command failed with exit code {e.returncode}")
+        sys.exit(e.returncode)
     except FileNotFoundError:
-        print(f"--- Error: Command not found - {command[0]}. Is it in your PATH?")
+        program = command if isinstance(command, str) else command[0]
+        print(f"--- Error: Command not found - {program}. Is it in your PATH?")
         sys.exit(1)
     except Exception as e:
         print(f"--- An unexpected error occurred: {e}")
@@ -82,7 +181,7 @@ def run_command(command, working_dir=None, env=None):
 
 def check_admin_privileges():
     """Checks for administrator privileges on Windows and exits if not found."""
-    if sys.platform != "win32":
+    if not _run._IS_WINDOWS:
         return # Not applicable for non-Windows platforms
     try:
         is_admin = (os.getuid() == 0)
@@ -100,11 +199,9 @@ def check_admin_privileges():
 
 def main():
     """Main function to orchestrate the build process."""
+    _run._exists.cache_clear()
     check_admin_privileges()
 
-    # --- Platform Detection ---
-    is_windows = sys.platform == "win32"
-    
     # --- Argument Parsing ---
     parser = argparse.ArgumentParser(
         description="WD Studios's V8 Build Script that supports all platforms. (non-console-version)",
@@ -118,6 +215,7 @@ def main():
     parser.add_argument('--v8-fork-branch', type=str, default='main', help='Branch, tag, or commit to check out from the custom fork.')
     parser.add_argument('--msvc', action='store_true', help='On Windows, add GN flags to explicitly use the MSVC toolchain instead of clang-cl.')
     parser.add_argument('--no-rust', action='store_true', help='Disable Rust toolchain download and dependency.')
+    parser.add_argument('--full-history', action='store_true', help='Fetch the complete V8 git history instead of a shallow checkout. Only needed for development on V8 itself.')
     parser.add_argument('--no-custom-cxx', action='store_true', help='Disable custom C++ toolchain download and dependency. The custom C++ toolchain causes problems with Windows builds.')
     args = parser.parse_args()
     
@@ -129,18 +227,20 @@ def main():
     print("-" * 30)
 
     # 1. Create and set up workspace and depot_tools
-    if not os.path.exists(V8_BASE_DIR):
-        os.makedirs(V8_BASE_DIR)
+    os.makedirs(V8_BASE_DIR, exist_ok=True)
 
     depot_tools_dir = os.path.join(V8_BASE_DIR, "depot_tools")
-    if not os.path.exists(depot_tools_dir):
+    if not _run._exists(depot_tools_dir):
         print("--- Cloning depot_tools...")
-        run_command(["git", "clone", DEPOT_TOOLS_URL, depot_tools_dir])
+        run_command(["git", "clone", "--depth=1", "--single-branch", DEPOT_TOOLS_URL, depot_tools_dir])
     else:
         print("--- depot_tools already exists.")
 
+    # Modify the environment once; every subprocess inherits it without an env= copy.
     os.environ["PATH"] = f"{depot_tools_dir}{os.pathsep}{os.environ['PATH']}"
-    if is_windows:
+    os.environ["GIT_HTTP_LOW_SPEED_LIMIT"] = GIT_LOW_SPEED_LIMIT
+    os.environ["GIT_HTTP_LOW_SPEED_TIME"] = GIT_LOW_SPEED_TIME
+    if _run._IS_WINDOWS:
         os.environ["DEPOT_TOOLS_WIN_TOOLCHAIN"] = "0"
     
     print("--- Bootstrapping depot_tools...")
@@ -148,9 +248,12 @@ def main():
 
     # 2. Fetch V8 source code
     v8_src_dir = os.path.join(V8_BASE_DIR, "v8")
-    if not os.path.exists(v8_src_dir):
+    if not _run._exists(v8_src_dir):
         print("--- Fetching official V8 source code (base)...")
-        run_command(["fetch", "v8"], working_dir=V8_BASE_DIR)
+        if args.full_history:
+            run_command(["fetch", "v8"], working_dir=V8_BASE_DIR)
+        else:
+            run_command(["fetch", "--no-history", "v8"], working_dir=V8_BASE_DIR)
     else:
         print("--- V8 source directory already exists.")
 
@@ -158,32 +261,45 @@ def main():
     if args.v8_fork_url:
         print(f"--- Integrating custom V8 fork from: {args.v8_fork_url}")
         # Check if remote already exists
-        try:
-            subprocess.check_output(["git", "remote", "get-url", "fork"], cwd=v8_src_dir, stderr=subprocess.STDOUT)
+        remotes = git_remotes(v8_src_dir)
+        if remotes is None:
+            # No readable .git/config (e.g. a worktree); ask git instead.
+            try:
+                subprocess.check_output(["git", "remote", "get-url", "fork"], cwd=v8_src_dir, stderr=subprocess.STDOUT)
+                remotes = {"fork"}
+            except subprocess.CalledProcessError:
+                remotes = set()
+        if "fork" in remotes:
             print("--- 'fork' remote already exists. Setting new URL.")
             run_command(["git", "remote", "set-url", "fork", args.v8_fork_url], working_dir=v8_src_dir)
-        except subprocess.CalledProcessError:
+        else:
             print("--- Adding 'fork' remote.")
             run_command(["git", "remote", "add", "fork", args.v8_fork_url], working_dir=v8_src_dir)
         
+        # Fetch only the requested ref (protocol v2 negotiates just that one) and check out
+        # exactly what was fetched; both run at the start of the build chain below.
         print("--- Fetching from custom fork...")
-        run_command(["git", "fetch", "fork"], working_dir=v8_src_dir)
+        fetch_command = ["git", "-c", "protocol.version=2", "fetch"]
+        if not args.full_history:
+            fetch_command.append("--depth=1")
+        # Forced ('+') update: a shallow fetch has no ancestry to prove a fast-forward, and the
+        # fork branch may have been rewritten since the last run.
+        fetch_command += ["fork", f"+{args.v8_fork_branch}:refs/remotes/fork/{args.v8_fork_branch}"]
         print(f"--- Checking out branch/tag: {args.v8_fork_branch}")
-        run_command(["git", "checkout", f"fork/{args.v8_fork_branch}"], working_dir=v8_src_dir)
+        checkout_commands = [fetch_command, ["git", "checkout", "--detach", "FETCH_HEAD"]]
     else:
         # Default to a recent known tag if no fork is specified.
-        run_command(["git", "checkout", "12.1.285.27"], working_dir=v8_src_dir)
+        checkout_commands = [["git", "checkout", V8_DEFAULT_TAG]]
+        if os.path.exists(os.path.join(v8_src_dir, ".git", "shallow")) and not git_has_tag(v8_src_dir, V8_DEFAULT_TAG):
+            # A shallow checkout only has the tip of the default branch; fetch just the tag.
+            checkout_commands.insert(0, ["git", "fetch", "--depth=1", "origin", "tag", V8_DEFAULT_TAG])
 
-    print("--- Synchronizing dependencies with gclient sync...")
-    run_command(["gclient", "sync"], working_dir=v8_src_dir)
-
-    # 4. Generate build files with GN
+    # 4. Prepare the GN build arguments
     output_path = f"out.gn/x64.{args.config}"
-    print(f"--- Generating build files in: {output_path}")
     
     gn_args = [
-        f'is_debug={str(args.config == "debug").lower()}',
-        'target_cpu=""x64""',
+        'is_debug=true' if args.config == 'debug' else 'is_debug=false',
+        'target_cpu="x64"',
         'v8_use_external_startup_data=false',
         'treat_warnings_as_errors=false',
     ]
@@ -199,13 +315,13 @@ def main():
         gn_args.extend(['is_component_build=true', 'v8_monolithic=false'])
         build_target = 'v8'
 
-    if is_windows and args.msvc:
+    if _run._IS_WINDOWS and args.msvc:
         print("--- Applying MSVC-specific GN flags...")
         gn_args.extend(['is_clang=false', 'v8_win_clang=false'])
-    elif not is_windows:
+    elif not _run._IS_WINDOWS:
         gn_args.append('is_clang=true')
 
-    if args.gn_args_file and os.path.exists(args.gn_args_file):
+    if args.gn_args_file and _run._exists(args.gn_args_file):
         print(f"--- Reading custom GN args from {args.gn_args_file}")
         with open(args.gn_args_file, 'r') as f:
             for line in f:
@@ -213,18 +329,42 @@ def main():
                 if line and not line.startswith('#'):
                     gn_args.append(line)
 
-    gn_command_str = f'gn gen {output_path} --args="{" ".join(gn_args)}"'
-    print(f"--- Using GN command: {gn_command_str}")
-    subprocess.run(gn_command_str, check=True, cwd=v8_src_dir, shell=True)
+    gn_command = ["gn", "gen", output_path, f'--args={" ".join(gn_args)}']
+    build_dir = os.path.join(v8_src_dir, output_path)
+    gn_digest = gn_command_digest(gn_command)
+
+    # 5. Check out, sync dependencies and generate build files with GN, then build V8 with Ninja.
+    # The stages up to gn gen run as one `&&`-linked shell command: a single process launch
+    # from Python, and the shell stops at the first stage that fails.
+    # Dependency fetching is network-bound, so run more git jobs than there are cores.
+    sync_command = ["gclient", "sync", f"--jobs={(os.cpu_count() or 1) * 2}"]
+    if not args.full_history:
+        sync_command.append("--no-history")
+    stages = checkout_commands + [sync_command]
+    # Checked against the tree before checkout/sync run; a checkout that moves the inputs is
+    # still picked up, because ninja re-runs gn itself when build.ninja is out of date.
+    run_gn_gen = not gn_gen_is_current(build_dir, gn_digest)
+    if run_gn_gen:
+        stages.append(gn_command)
+    else:
+        print(f"--- GN args and inputs unchanged, skipping gn gen for: {output_path}")
+    ninja_command = ["ninja", "-C", output_path, build_target]
+    print(f"--- Building V8 target '{build_target}' in {output_path}. Stages (the chain stops at the first failure):")
+    for number, stage in enumerate(stages + [ninja_command], 1):
+        print(f"  {number}. {' '.join(stage)}")
+    run_command(_run.chain_commands(stages), working_dir=v8_src_dir)
+    # Record the generated state before building, so a failed ninja run does not force
+    # gn gen to run again next time.
+    if run_gn_gen:
+        record_gn_state(build_dir, gn_digest)
 
-    # 5. Build V8 with Ninja
-    print(f"--- Building V8 target '{build_target}' with Ninja...")
-    run_command(["ninja", "-C", output_path, build_target], working_dir=v8_src_dir)
+    run_command(ninja_command, working_dir=v8_src_dir)
+    # Ninja re-runs gn by itself when its inputs changed; refresh the manifest to match.
+    record_gn_state(build_dir, gn_digest)
 
     # 6. Final output message
     print(f"\n--- V8 ({args.build_type} / {args.config} build) Process Completed Successfully! ---")
-    final_output_dir = os.path.join(v8_src_dir, output_path)
-    print(f"Build artifacts are located in: {final_output_dir}")
+    print(f"Build artifacts are located in: {build_dir}")
     print(f"Include headers are located at: {os.path.join(v8_src_dir, 'include')}")
 
 if __name__ == "__main__":